@@ -1,17 +1,159 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
 import pybedtools as pbt
 from pybedtools.bedtool import BEDToolsError
 import keras
-import sklearn.utils
-from .wrapper import BedWrapper
+from numba import njit
+from .wrapper import BedWrapper, GenomeWrapper
 
 
-class MultiBedGenerator(keras.utils.Sequence):
+# Kernels are compiled eagerly for fixed signatures and cached on disk, so their compilation cost is paid once per
+# installation rather than on the first batch of every run. They are single-threaded and release the GIL: batches are
+# parallelized across loader threads instead, which numba's default workqueue threading layer cannot run parallel
+# kernels from concurrently.
+@njit('void(int64[::1], int64[::1], float64[::1], int64[::1], int64, float64, uint8[::1])',
+      cache=True, fastmath=True, nogil=True)
+def _threshold_labels(seg_starts, seg_ends, seg_values, starts, w, thr, out):
+    # Labels each window of width w as positive if the per-base sum of the segment data it covers reaches thr.
+    # Segments must be sorted and non-overlapping, so that their ends are sorted too.
+    n = seg_starts.shape[0]
+    for i in range(starts.shape[0]):
+        window_start = starts[i]
+        window_end = window_start + w
+        s = 0.0
+        j = np.searchsorted(seg_ends, window_start, side='right')
+        while j < n and seg_starts[j] < window_end:
+            s += (min(seg_ends[j], window_end) - max(seg_starts[j], window_start)) * seg_values[j]
+            j += 1
+        out[i] = s >= thr
+
+
+@njit('UniTuple(int64[::1], 3)(int64[::1], int64[::1], int64[::1])', cache=True, fastmath=True, nogil=True)
+def _merge_intervals(chroms, starts, ends):
+    # Sorts intervals by chromosome index and start, then merges overlapping and book-ended intervals in one sweep.
+    # Merge sort stays fast on the nearly sorted input of exclusions with a few appended windows.
+    n = starts.shape[0]
+    merged_chroms = np.empty(n, dtype=np.int64)
+    merged_starts = np.empty(n, dtype=np.int64)
+    merged_ends = np.empty(n, dtype=np.int64)
+    order = np.argsort((chroms << 32) + starts, kind='mergesort')
+    m = 0
+    for k in range(n):
+        i = order[k]
+        if m > 0 and chroms[i] == merged_chroms[m - 1] and starts[i] <= merged_ends[m - 1]:
+            merged_ends[m - 1] = max(merged_ends[m - 1], ends[i])
+        else:
+            merged_chroms[m] = chroms[i]
+            merged_starts[m] = starts[i]
+            merged_ends[m] = ends[i]
+            m += 1
+    return merged_chroms[:m].copy(), merged_starts[:m].copy(), merged_ends[:m].copy()
+
+
+@njit('void(float64[::1], int64[::1], int64[::1], int64[::1], int64[::1], float64[::1], float64[::1], int64[::1], '
+      'int64[::1], uint8[::1])', cache=True, fastmath=True, nogil=True)
+def _draw_windows(chrom_cdf, chrom_sizes, excl_start_keys, excl_end_keys, widths, u_chroms, u_starts, out_chroms,
+                  out_starts, placed):
+    # Maps uniform draws to a chromosome, weighted by size, and a start for each window, and flags the windows that
+    # avoid every exclusion. Exclusions must be merged and encoded as sorted (chromosome << 32) + position keys.
+    for i in range(widths.shape[0]):
+        c = min(np.searchsorted(chrom_cdf, u_chroms[i], side='right'), chrom_cdf.shape[0] - 1)
+        w = widths[i]
+        n_starts = chrom_sizes[c] - w + 1
+        out_chroms[i] = c
+        if n_starts <= 0:
+            out_starts[i] = 0
+            placed[i] = False
+            continue
+        start = np.int64(u_starts[i] * n_starts)
+        out_starts[i] = start
+        start_key = (c << 32) + start
+        # Only the last exclusion starting before the window ends can overlap it
+        j = np.searchsorted(excl_start_keys, start_key + w) - 1
+        placed[i] = j < 0 or excl_end_keys[j] <= start_key
+
+
+@njit('void(int64[::1], int64[::1], int64, int64[::1])', cache=True, fastmath=True, nogil=True)
+def _compute_windows(starts, ends, seq_len, out_starts):
+    # Centers a window of length seq_len on each interval
+    half_seq = seq_len // 2
+    for i in range(starts.shape[0]):
+        out_starts[i] = (starts[i] + ends[i]) // 2 - half_seq
+
+
+def _specialize_windows(seq_len, window_len, output_seq_len, jitter_mode, left_justify):
+    """Builds a compiled kernel computing jittered window midpoints and starts for one generator configuration. The
+    configuration is captured as closure constants, so numba folds it into the kernel and prunes the branches that do
+    not apply. Each configuration is cached on disk separately."""
+    half_seq = seq_len // 2
+    half_output = output_seq_len // 2
+    sliding = jitter_mode == 'sliding'
+    fixed_shift = half_output if jitter_mode == 'unet' or jitter_mode == 'simple' else 0
+
+    @njit(cache=True, fastmath=True, nogil=True)
+    def compute_windows(chrom_starts, chrom_ends, jitter, midpts, starts):
+        # jitter holds uniform draws in [0, 1), mapped to a shift in [-shift_size, shift_size]
+        for i in range(chrom_starts.shape[0]):
+            if left_justify:
+                midpt = chrom_starts[i] + half_output
+            else:
+                midpt = (chrom_starts[i] + chrom_ends[i]) // 2
+            if sliding:
+                shift_size = max(midpt - chrom_starts[i], (window_len - (chrom_ends[i] - chrom_starts[i])) // 2)
+            else:
+                shift_size = fixed_shift
+            midpt += np.int64(jitter[i] * (2 * shift_size + 1)) - shift_size
+            midpts[i] = midpt
+            starts[i] = midpt - half_seq
+
+    return compute_windows
+
+
+def _probe_window(signal, chrom, length, genome_dtype=None):
+    """Returns the shape and dtype of a window of the given length fetched from a signal. One-hot genome windows take
+    genome_dtype instead, if given."""
+    window = signal[chrom, 0:length]
+    if genome_dtype is not None and isinstance(signal, GenomeWrapper) and signal.one_hot:
+        return window.shape, np.dtype(genome_dtype)
+    return window.shape, window.dtype
+
+
+class PrefetchSequence(keras.utils.Sequence):
+    """Sequence whose iterator assembles upcoming batches in a thread pool, overlapping data loading with training.
+    The compiled kernels and memory-mapped reads release the GIL, whereas 2bit and FASTA reads hold it. When training
+    with fit_generator, pass workers > 1 and use_multiprocessing=False instead."""
+    def __init__(self, prefetch=0):
+        self.prefetch = prefetch
+        self._prefetch_pool = ThreadPoolExecutor(max_workers=prefetch) if prefetch > 0 else None
+
+    def _check_thread_safe(self, wrappers):
+        # Batches are assembled concurrently when prefetching, so every wrapper they read from must be thread safe
+        if self.prefetch > 0 and not all(getattr(wrapper, 'thread_safe', True) for wrapper in wrappers):
+            raise ValueError('prefetch requires wrappers opened with thread_safe=True or in_mem=True')
+
+    def __iter__(self):
+        n = len(self)
+        if self._prefetch_pool is None:
+            for i in range(n):
+                yield self[i]
+            return
+        futures = deque(self._prefetch_pool.submit(self.__getitem__, i) for i in range(min(self.prefetch, n)))
+        for i in range(n):
+            batch = futures.popleft().result()
+            if i + self.prefetch < n:
+                futures.append(self._prefetch_pool.submit(self.__getitem__, i + self.prefetch))
+            yield batch
+
+
+class MultiBedGenerator(PrefetchSequence):
     def __init__(self, beds, signals, output_signals=None, extra=None, blacklist=None, batch_size=128, window_len=200,
                  seq_len=1024, output_seq_len=None, negatives_ratio=1, return_sequences=False, jitter_mode='sliding',
-                 left_justify=False, epochs_reset=10, return_output=True, shuffle=True):
+                 left_justify=False, epochs_reset=10, return_output=True, shuffle=True, seed=None,
+                 pack_labels=False, prefetch=0, native_shuffle=True, genome_dtype=np.uint8, max_tries=1000):
         # Initialization
+        super().__init__(prefetch)
         self.beds = beds
         beds_bt = [bed.bt for bed in beds]
         if len(beds_bt) == 1:
@@ -26,11 +168,12 @@ class MultiBedGenerator(keras.utils.Sequence):
             self.master_bed = BedWrapper(master_bed_bt.fn)
         self.signals = signals
         self.output_signals = [] if output_signals is None else output_signals
+        self._check_thread_safe(list(self.signals) + list(self.output_signals))
         self.blacklist = blacklist
         self.batch_size = batch_size
         self.epoch_i = -1
         self.epochs_reset = epochs_reset
-        self.intervals_df_epoch_i = None
+        self._perm = None
         self.window_len = window_len
         if type(window_len) is not int or window_len < 0:
             raise ValueError('window_len must be positive integer')
@@ -44,11 +187,31 @@ class MultiBedGenerator(keras.utils.Sequence):
         self.return_sequences = return_sequences
         self.left_justify = left_justify
         self.return_output = return_output
+        if pack_labels and (return_sequences or len(self.output_signals) > 0):
+            raise ValueError('pack_labels requires BED classification labels')
+        self.pack_labels = pack_labels
+        self.n_labels = len(beds)
         jitter_modes = ['sliding', 'unet', 'simple', None]
         if jitter_mode not in jitter_modes:
             raise ValueError('Invalid jitter mode. Expected one of: %s' % jitter_modes)
         self.jitter_mode = jitter_mode
+        # Specialize batch assembly to this configuration, which is fixed for the lifetime of the generator
+        self._window_kernel = _specialize_windows(seq_len, window_len, output_seq_len, jitter_mode, left_justify)
+        if not return_output:
+            self._labeler = None
+        elif return_sequences:
+            self._labeler = self._sequence_labels
+        elif len(self.output_signals) > 0:
+            self._labeler = self._signal_labels
+        else:
+            self._labeler = self._bed_labels
         self.shuffle = shuffle
+        self.native_shuffle = native_shuffle
+        self.max_tries = max_tries
+        # Epoch-level draws come from rng, while each batch draws its jitter from a generator keyed on the epoch and
+        # batch index, so that batches are reproducible whatever order threads assemble them in
+        self._seed_seq = np.random.SeedSequence(seed)
+        self.rng = np.random.default_rng(self._seed_seq)
         # Will only shuffle intervals within chromosomes occupied by BED intervals
         genome_chromsizes = signals[0].chroms_size_pybedtools()
         bed_chroms = self.master_bed.chroms()
@@ -56,94 +219,230 @@ class MultiBedGenerator(keras.utils.Sequence):
         for chrom in bed_chroms:
             self.chromsizes[chrom] = genome_chromsizes[chrom]
         self.master_bed.bt.set_chromsizes(self.chromsizes)
+        self._chrom_names = np.array(list(self.chromsizes), dtype=object)
+        self._chrom_index = pd.Index(self._chrom_names)
+        self._chrom_sizes = np.array([self.chromsizes[chrom][1] for chrom in self._chrom_names], dtype=np.int64)
+        # Probe input and output window shapes once so that batches can be preallocated
+        probe_chrom = bed_chroms[0]
+        self._x_specs = [_probe_window(signal, probe_chrom, seq_len, genome_dtype) for signal in signals]
+        if return_sequences:
+            label_sources = beds if len(self.output_signals) == 0 else self.output_signals
+            labels = [source[probe_chrom, 0:output_seq_len] for source in label_sources]
+            # Channel offsets of each label source within the concatenated output
+            self._label_offsets = np.cumsum([0] + [label.shape[-1] for label in labels]).tolist()
+            label = np.concatenate(labels, axis=-1)
+            self._y_spec = (label.shape, label.dtype)
+        elif len(self.output_signals) == 0:
+            self._y_spec = ((len(beds),), np.uint8)
+        else:
+            self._y_spec = ((len(self.output_signals),), np.float32)
         self.negative_windows_epoch_i = None
-        self.cumulative_excl_bt = None
+        self.cumulative_excl = None
         self._reset_negatives()
         self.on_epoch_end()
 
     def __len__(self):
         """Denotes the number of batches per epoch"""
-        return int(np.ceil(len(self.intervals_df_epoch_i) / self.batch_size))
+        return int(np.ceil(len(self._perm) / self.batch_size))
         # return int(np.ceil((1.0 + self.negatives_ratio) * len(self.bed) / self.batch_size))
 
     def __getitem__(self, index):
         """Generate one batch of data"""
         # Collect genome intervals of the batch
-        intervals_batch_df = self.intervals_df_epoch_i[index * self.batch_size:(index + 1) * self.batch_size]
-        x_signals = [[] for _ in range(len(self.signals))]
-        y = []
-        for interval in intervals_batch_df.itertuples():
-            chrom = interval[1]
-            chrom_start = interval[2]
-            chrom_end = interval[3]
-            if self.left_justify:
-                midpt = chrom_start + self.output_seq_len / 2
-            else:
-                midpt = (chrom_start + chrom_end) / 2
-            if self.jitter_mode == 'sliding':
-                interval_len = chrom_end - chrom_start
-                shift_size = np.max([midpt - chrom_start, int((self.window_len - interval_len) / 2)])
-            elif self.jitter_mode == 'unet' or self.jitter_mode == 'simple':
-                shift_size = self.output_seq_len / 2
-            else:
-                shift_size = 0
-            s = np.random.randint(-shift_size, shift_size + 1)
-            midpt += s
-            start = int(midpt - self.seq_len / 2)
-            stop = start + self.seq_len
-            for i in range(len(self.signals)):
-                x_signals[i].append(self.signals[i][chrom, start:stop])
-            label = []
-            if self.return_output:
-                if len(self.output_signals) == 0:
-                    for bed in self.beds:
-                        if self.return_sequences:
-                            start_output = int(midpt - self.output_seq_len / 2)
-                            stop_output = start_output + self.output_seq_len
-                            label_i = bed[chrom, start_output:stop_output]
-                        else:
-                            start_window = int(midpt - self.window_len / 2)
-                            stop_window = start_window + self.window_len
-                            label_i = bed[chrom, start_window:stop_window].sum() >= self.window_len / 2
-                        label.append(label_i)
-                else:
-                    for output_signal in self.output_signals:
-                        if self.return_sequences:
-                            start_output = int(midpt - self.output_seq_len / 2)
-                            stop_output = start_output + self.output_seq_len
-                            label_i = output_signal[chrom, start_output:stop_output]
-                        else:
-                            start_window = int(midpt - self.window_len / 2)
-                            stop_window = start_window + self.window_len
-                            label_i = output_signal[chrom, start_window:stop_window].mean()
-                        label.append(label_i)
-                if self.return_sequences:
-                    label = np.concatenate(label, axis=-1)
-                y.append(label)
-
-        x = [np.array(x_signal) for x_signal in x_signals]
+        idx = self._perm[index * self.batch_size:(index + 1) * self.batch_size]
+        chroms, chrom_starts, chrom_ends = self._gather_intervals(idx)
+        batch_size = len(chroms)
+        midpts = np.empty(batch_size, dtype=np.int64)
+        starts = np.empty(batch_size, dtype=np.int64)
+        batch_rng = np.random.default_rng(np.random.SeedSequence(self._seed_seq.entropy,
+                                                                 spawn_key=(self.epoch_i, index)))
+        self._window_kernel(chrom_starts, chrom_ends, batch_rng.random(batch_size), midpts, starts)
+        x = [np.empty((batch_size,) + shape, dtype=dtype) for shape, dtype in self._x_specs]
+        for signal, x_signal in zip(self.signals, x):
+            signal.fill_windows(chroms, starts, self.seq_len, x_signal)
         if len(x) == 1:
             x = x[0]
-        if self.return_output:
-            y = np.array(y)
-            return x, y
-        return x
+        if self._labeler is None:
+            return x
+        y_shape, y_dtype = self._y_spec
+        y = np.empty((batch_size,) + y_shape, dtype=y_dtype)
+        return x, self._labeler(chroms, midpts, y)
+
+    @property
+    def intervals_df_epoch_i(self):
+        """The intervals of the current epoch, in batch order, as a BED DataFrame. Built on request."""
+        chroms, starts, ends = self._gather_intervals(self._perm)
+        return pd.DataFrame({'chrom': chroms, 'chromStart': starts, 'chromEnd': ends})
+
+    def _gather_intervals(self, idx):
+        # Resolves epoch indices to intervals; indices below the number of positives refer to the positive intervals,
+        # the rest to this epoch's negative windows
+        pos_chroms, pos_starts, pos_ends = self.master_bed.columns
+        neg_chroms, neg_starts, neg_ends = self.negative_windows_epoch_i
+        n_pos = len(pos_starts)
+        is_pos = idx < n_pos
+        pos_idx = idx[is_pos]
+        neg_idx = idx[~is_pos] - n_pos
+        chroms = np.empty(len(idx), dtype=object)
+        starts = np.empty(len(idx), dtype=np.int64)
+        ends = np.empty(len(idx), dtype=np.int64)
+        chroms[is_pos] = pos_chroms[pos_idx]
+        chroms[~is_pos] = self._chrom_names[neg_chroms[neg_idx]]
+        starts[is_pos] = pos_starts[pos_idx]
+        starts[~is_pos] = neg_starts[neg_idx]
+        ends[is_pos] = pos_ends[pos_idx]
+        ends[~is_pos] = neg_ends[neg_idx]
+        return chroms, starts, ends
+
+    def _sequence_labels(self, chroms, midpts, y):
+        # Per-base labels of each BED file or output signal, concatenated along the channel axis
+        output_seq_len = self.output_seq_len
+        label_sources = self.beds if len(self.output_signals) == 0 else self.output_signals
+        offsets = self._label_offsets
+        start_outputs = midpts - output_seq_len // 2
+        for i, (chrom, start_output) in enumerate(zip(chroms, start_outputs)):
+            stop_output = start_output + output_seq_len
+            for b, source in enumerate(label_sources):
+                y[i, ..., offsets[b]:offsets[b + 1]] = source[chrom, start_output:stop_output]
+        return y
+
+    def _signal_labels(self, chroms, midpts, y):
+        # Mean of each output signal over the central window
+        window_len = self.window_len
+        output_signals = self.output_signals
+        start_windows = midpts - window_len // 2
+        for i, (chrom, start_window) in enumerate(zip(chroms, start_windows)):
+            stop_window = start_window + window_len
+            for k, output_signal in enumerate(output_signals):
+                y[i, k] = output_signal[chrom, start_window:stop_window].mean()
+        return y
+
+    def _bed_labels(self, chroms, midpts, y):
+        # Whether each BED file covers at least half of the central window, computed with a compiled kernel once per
+        # chromosome and BED file
+        window_len = self.window_len
+        threshold = window_len / 2
+        start_windows = midpts - window_len // 2
+        labels = np.empty(len(chroms), dtype=np.uint8)
+        for chrom in np.unique(chroms):
+            idx = np.flatnonzero(chroms == chrom)
+            chrom_start_windows = start_windows[idx]
+            chrom_labels = labels[:len(idx)]
+            for b, bed in enumerate(self.beds):
+                _threshold_labels(*bed.segments(chrom), chrom_start_windows, window_len, threshold, chrom_labels)
+                y[idx, b] = chrom_labels
+        if self.pack_labels:
+            # Unpack with np.unpackbits(y, axis=1, count=self.n_labels)
+            y = np.packbits(y, axis=1)
+        return y
 
     def _reset_negatives(self):
-        if self.negatives_ratio > 1:
-            self.negative_windows_epoch_i = BedWrapper(pbt.BedTool.cat(*(self.negatives_ratio * [self.master_bed.bt]),
-                                                                       postmerge=False).fn)
-        elif self.negatives_ratio == 1:
-            self.negative_windows_epoch_i = self.master_bed
-        else:
-            self.negative_windows_epoch_i = BedWrapper(pbt.BedTool([]).fn)
-        self.negative_windows_epoch_i.bt.set_chromsizes(self.chromsizes)
+        chroms, starts, ends = self._interval_arrays(*self.master_bed.columns)
+        # Each epoch's negatives take the widths of negatives_ratio copies of the positive intervals
+        self.negative_windows_epoch_i = tuple(np.tile(arrays, self.negatives_ratio)
+                                              for arrays in (chroms, starts, ends))
         if self.jitter_mode == 'sliding':
-            self.cumulative_excl_bt = self.master_bed.bt.slop(b=self.window_len / 2)
-        else:
-            self.cumulative_excl_bt = self.master_bed.bt
+            starts = np.maximum(starts - self.window_len // 2, 0)
+            ends = np.minimum(ends + self.window_len // 2, self._chrom_sizes[chroms])
+        excl = [(chroms, starts, ends)]
         if self.blacklist is not None:
-            self.cumulative_excl_bt = self.cumulative_excl_bt.cat(self.blacklist.bt)
+            excl.append(self._interval_arrays(*self.blacklist.columns))
+        self.cumulative_excl = _merge_intervals(*(np.concatenate(arrays) for arrays in zip(*excl)))
+
+    def _interval_arrays(self, chroms, starts, ends):
+        # Converts chromosome names into indices, dropping intervals on chromosomes that negatives are not sampled from
+        chrom_ids = self._chrom_index.get_indexer(chroms)
+        keep = chrom_ids >= 0
+        return (chrom_ids[keep].astype(np.int64),
+                np.asarray(starts, dtype=np.int64)[keep],
+                np.asarray(ends, dtype=np.int64)[keep])
+
+    def _cumulative_excl_bed(self):
+        # Writes the cumulative exclusion intervals to a BED file for BEDTools
+        chroms, starts, ends = self.cumulative_excl
+        excl_df = pd.DataFrame({'chrom': self._chrom_names[chroms], 'start': starts, 'end': ends})
+        return pbt.BedTool.from_dataframe(excl_df).fn
+
+    def _shuffle_negatives(self, drop_unplaced=False):
+        # Moves the current negative windows to random locations that overlap neither the cumulative exclusions nor
+        # each other. Raises BEDToolsError when no such placement is found, unless drop_unplaced is set, in which case
+        # the windows that could not be placed are left out.
+        if self.native_shuffle:
+            return self._sample_negatives(drop_unplaced=drop_unplaced)
+        chroms, starts, ends = self.negative_windows_epoch_i
+        negatives_df = pd.DataFrame({'chrom': self._chrom_names[chroms], 'start': starts, 'end': ends})
+        negatives_bt = pbt.BedTool.from_dataframe(negatives_df)
+        negatives_bt.set_chromsizes(self.chromsizes)
+        try:
+            negatives_bt = negatives_bt.shuffle(excl=self._cumulative_excl_bed(), noOverlapping=True,
+                                                seed=self.rng.integers(np.iinfo(np.uint32).max + 1),
+                                                maxTries=self.max_tries)
+        except BEDToolsError as e:
+            if not drop_unplaced:
+                raise
+            raise RuntimeError('BEDTools could not place the negative windows clear of the exclusions even after a '
+                               'reset; negatives_ratio=%d may be too high for this genome'
+                               % self.negatives_ratio) from e
+        negatives_df = negatives_bt.to_dataframe()
+        return self._interval_arrays(negatives_df.chrom, negatives_df.start, negatives_df.end)
+
+    def _sample_negatives(self, drop_unplaced=False):
+        # In-process replacement for BEDTools shuffle. Windows are placed by rejection sampling; each round redraws
+        # the windows that hit an exclusion or another window. Like BEDTools, each window gets up to max_tries draws,
+        # after which it is dropped if drop_unplaced is set.
+        chroms, starts, ends = self.negative_windows_epoch_i
+        widths = ends - starts
+        chrom_cdf = np.cumsum(self._chrom_sizes) / self._chrom_sizes.sum()
+        excl_chroms, excl_starts, excl_ends = self.cumulative_excl
+        excl_start_keys = (excl_chroms << 32) + excl_starts
+        excl_end_keys = (excl_chroms << 32) + excl_ends
+        # Keys of the windows accepted so far, kept sorted. The windows do not overlap, so their end keys are sorted
+        # too. The caller merges them into the exclusions at the next epoch.
+        accepted_start_keys = np.empty(0, dtype=np.int64)
+        accepted_end_keys = np.empty(0, dtype=np.int64)
+        sampled_chroms = np.empty(len(widths), dtype=np.int64)
+        sampled_starts = np.empty(len(widths), dtype=np.int64)
+        pending = np.arange(len(widths))
+        for _ in range(self.max_tries):
+            if len(pending) == 0:
+                break
+            n_pending = len(pending)
+            pending_widths = widths[pending]
+            draw_chroms = np.empty(n_pending, dtype=np.int64)
+            draw_starts = np.empty(n_pending, dtype=np.int64)
+            placed = np.empty(n_pending, dtype=np.uint8)
+            _draw_windows(chrom_cdf, self._chrom_sizes, excl_start_keys, excl_end_keys, pending_widths,
+                          self.rng.random(n_pending), self.rng.random(n_pending), draw_chroms, draw_starts, placed)
+            # Of the windows clear of exclusions, drop those that overlap a window accepted in an earlier round. Only
+            # the last accepted window starting before a window ends can overlap it.
+            placed = np.flatnonzero(placed)
+            start_keys = (draw_chroms[placed] << 32) + draw_starts[placed]
+            end_keys = start_keys + pending_widths[placed]
+            j = np.searchsorted(accepted_start_keys, end_keys) - 1
+            clear = j < 0
+            check = ~clear
+            clear[check] = accepted_end_keys[j[check]] <= start_keys[check]
+            placed, start_keys, end_keys = placed[clear], start_keys[clear], end_keys[clear]
+            # Of the rest, keep those that do not overlap a window drawn before them
+            order = np.argsort(start_keys, kind='mergesort')
+            sorted_start_keys = start_keys[order]
+            sorted_end_keys = end_keys[order]
+            keep = np.ones(len(order), dtype=bool)
+            keep[1:] = sorted_start_keys[1:] >= np.maximum.accumulate(sorted_end_keys)[:-1]
+            accepted = placed[order[keep]]
+            sampled_chroms[pending[accepted]] = draw_chroms[accepted]
+            sampled_starts[pending[accepted]] = draw_starts[accepted]
+            insert_at = np.searchsorted(accepted_start_keys, sorted_start_keys[keep])
+            accepted_start_keys = np.insert(accepted_start_keys, insert_at, sorted_start_keys[keep])
+            accepted_end_keys = np.insert(accepted_end_keys, insert_at, sorted_end_keys[keep])
+            pending = np.delete(pending, accepted)
+        if len(pending) > 0:
+            if not drop_unplaced:
+                raise BEDToolsError(cmd=None, msg=None)
+            placed = np.ones(len(widths), dtype=bool)
+            placed[pending] = False
+            sampled_chroms, sampled_starts, widths = sampled_chroms[placed], sampled_starts[placed], widths[placed]
+        return sampled_chroms, sampled_starts, sampled_starts + widths
 
     def on_epoch_end(self):
         self.epoch_i += 1
@@ -153,31 +452,26 @@ class MultiBedGenerator(keras.utils.Sequence):
         try:
             if self.epoch_i != 0 and self.epoch_i % self.epochs_reset == 0:
                 raise BEDToolsError(cmd=None, msg=None)
-            self.cumulative_excl_bt = pbt.BedTool(self.cumulative_excl_bt.cat(self.negative_windows_epoch_i.bt,
-                                                                              postmerge=True))
-            negative_windows_bt = self.negative_windows_epoch_i.bt.shuffle(excl=self.cumulative_excl_bt.fn,
-                                                                           noOverlapping=True,
-                                                                           seed=np.random.randint(
-                                                                               np.iinfo(np.uint32).max + 1),
-                                                                           maxTries=3)
+            self.cumulative_excl = _merge_intervals(*(np.concatenate(arrays) for arrays in
+                                                      zip(self.cumulative_excl, self.negative_windows_epoch_i)))
+            negative_windows = self._shuffle_negatives()
         except BEDToolsError:  # Cannot find any more non-overlapping intervals or on a 10th epoch, reset
             self._reset_negatives()
-            negative_windows_bt = self.negative_windows_epoch_i.bt.shuffle(excl=self.cumulative_excl_bt.fn,
-                                                                           noOverlapping=True,
-                                                                           seed=np.random.randint(
-                                                                               np.iinfo(np.uint32).max + 1),
-                                                                           maxTries=3)
-        self.negative_windows_epoch_i = BedWrapper(negative_windows_bt.fn)
-        self.negative_windows_epoch_i.bt.set_chromsizes(self.chromsizes)
-        intervals_df_list_epoch_i = [self.master_bed.df, self.negative_windows_epoch_i.df]
-        self.intervals_df_epoch_i = pd.concat(intervals_df_list_epoch_i)
+            negative_windows = self._shuffle_negatives(drop_unplaced=True)
+        self.negative_windows_epoch_i = negative_windows
+        # Positives and negatives are kept apart; the epoch order is a permutation over both
+        n_intervals = len(self.master_bed.columns[0]) + len(negative_windows[0])
         if self.shuffle:
-            self.intervals_df_epoch_i = sklearn.utils.shuffle(self.intervals_df_epoch_i)
+            self._perm = self.rng.permutation(n_intervals)
+        else:
+            self._perm = np.arange(n_intervals)
 
 
-class BedGraphGenerator(keras.utils.Sequence):
-    def __init__(self, bedgraph, genome, signals=[], batch_size=128, seq_len=1024, return_sequences=False, shuffle=True):
+class BedGraphGenerator(PrefetchSequence):
+    def __init__(self, bedgraph, genome, signals=[], batch_size=128, seq_len=1024, return_sequences=False, shuffle=True,
+                 prefetch=0, genome_dtype=np.uint8):
         # Initialization
+        super().__init__(prefetch)
         self.bedgraph = bedgraph
         self.genome = genome
         self.batch_size = batch_size
@@ -185,6 +479,16 @@ class BedGraphGenerator(keras.utils.Sequence):
         self.seq_len = seq_len
         self.return_sequences = return_sequences
         self.shuffle = shuffle
+        self._inputs = [genome] + list(signals)
+        self._check_thread_safe(self._inputs + [bedgraph])
+        # Probe input and output window shapes once so that batches can be preallocated
+        probe_chrom, probe_start, probe_end = bedgraph.df.iloc[0, :3]
+        self._window_len = probe_end - probe_start if seq_len is None else seq_len
+        self._x_specs = [_probe_window(signal, probe_chrom, self._window_len, genome_dtype) for signal in self._inputs]
+        if return_sequences:
+            self._y_spec = _probe_window(bedgraph, probe_chrom, self._window_len)
+        else:
+            self._y_spec = ((), bedgraph.dtype)
         self.on_epoch_end()
 
     def __len__(self):
@@ -193,41 +497,36 @@ class BedGraphGenerator(keras.utils.Sequence):
 
     def __getitem__(self, index):
         'Generate one batch of data'
+        window_len = self._window_len
         # Collect genome intervals of the batch
-        intervals_df = self.bedgraph.df[index*self.batch_size:(index+1)*self.batch_size]
-        x_genome = []
-        x_signals = [[] for _ in range(len(self.signals))]
-        y = []
-        for interval in intervals_df.itertuples():
-            chrom = interval[1]
-            chrom_start = interval[2]
-            chrom_end = interval[3]
-            label = interval[4]
-            if self.seq_len is None:
-                start = chrom_start
-                stop = chrom_end
-            else:
-                midpt = (chrom_start + chrom_end) / 2
-                start = int(midpt - self.seq_len / 2)
-                stop = start + self.seq_len
-            x_genome.append(self.genome[chrom, start:stop])
-            for i in range(len(self.signals)):
-                x_signals[i].append(self.signals[i][chrom, start:stop])
-            if self.return_sequences:
-                label = self.bedgraph[chrom, start:stop]
-            y.append(label)
-
-        x_genome = np.array(x_genome)
-        if len(self.signals) == 0:
-            x = x_genome
+        batch = slice(index * self.batch_size, (index + 1) * self.batch_size)
+        chroms = self._chroms[batch]
+        batch_size = len(chroms)
+        x = [np.empty((batch_size,) + shape, dtype=dtype) for shape, dtype in self._x_specs]
+        y_shape, y_dtype = self._y_spec
+        y = np.empty((batch_size,) + y_shape, dtype=y_dtype)
+        if self.seq_len is None:
+            starts = self._starts[batch]
+        else:
+            starts = np.empty(batch_size, dtype=np.int64)
+            _compute_windows(self._starts[batch], self._ends[batch], self.seq_len, starts)
+        for signal, x_signal in zip(self._inputs, x):
+            signal.fill_windows(chroms, starts, window_len, x_signal)
+        if self.return_sequences:
+            bedgraph = self.bedgraph
+            for i, (chrom, start) in enumerate(zip(chroms, starts)):
+                y[i] = bedgraph[chrom, start:start + window_len]
         else:
-            x = [x_genome]
-            for x_signal in x_signals:
-                x.append(np.array(x_signal))
-        y = np.array(y)
+            y[:] = self._labels[batch]
+
+        if len(self.signals) == 0:
+            x = x[0]
         return x, y
 
     def on_epoch_end(self):
         'Updates indexes after each epoch'
         if self.shuffle:
             self.bedgraph.shuffle()
+        # Cache the intervals as columnar arrays so that batches are assembled without pandas
+        self._chroms, self._starts, self._ends = self.bedgraph.columns
+        self._labels = self.bedgraph.df.iloc[:, 3].to_numpy(dtype=np.float32)
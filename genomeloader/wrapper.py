@@ -1,3 +1,5 @@
+import json
+import threading
 import numpy as np
 import pandas as pd
 import pybedtools as pbt
@@ -7,14 +9,61 @@ import py2bit
 import pyBigWig
 from intervaltree import IntervalTree
 from tqdm import tqdm
-import sklearn.utils
+from numba import njit
+
+
+# Output dtypes that _one_hot is compiled for. Windows of any other dtype are encoded through GenomeWrapper instead.
+_ONE_HOT_DTYPES = (np.bool_, np.uint8, np.int8, np.float32, np.float64)
+
+
+@njit(['void(uint8[::1], %s[:, ::1])' % dtype for dtype in ('boolean', 'uint8', 'int8', 'float32', 'float64')],
+      cache=True, fastmath=True, nogil=True)
+def _one_hot(codes, out):
+    # Writes the one-hot encoding of residue codes into out. Codes past the alphabet (ambiguous residues) are all zero.
+    n_residues = out.shape[1]
+    for p in range(codes.shape[0]):
+        for r in range(n_residues):
+            out[p, r] = codes[p] == r
+
+
+class LRUCache:
+    """Thread-safe least-recently-used cache of numpy arrays, bounded by their total size in bytes"""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            if key in self._items:
+                return
+            self._items[key] = value
+            self.nbytes += value.nbytes
+            while self.nbytes > self.max_bytes and len(self._items) > 1:
+                _, evicted = self._items.popitem(last=False)
+                self.nbytes -= evicted.nbytes
 
 
 class SignalWrapper:
-    def __init__(self, channel_last=True, in_mem=False, thread_safe=False):
+    def __init__(self, channel_last=True, in_mem=False, thread_safe=False, cache_bytes=0, cache_chunk_size=131072):
         self.channel_last = channel_last
         self.in_mem = in_mem
         self.thread_safe = thread_safe
+        # Recently read sequence chunks are kept in memory so that nearby reads skip the underlying file. Cached chunks
+        # are read-only; subclasses copy them before handing them out, so callers always get writeable arrays.
+        self.cache_chunk_size = cache_chunk_size
+        self._cache = LRUCache(cache_bytes) if cache_bytes > 0 and not in_mem else None
 
     def __del__(self):
         self.close()
@@ -47,7 +96,10 @@ class SignalWrapper:
         chrom_size = self._chroms_size[chrom]
         start = int(max(0, coords.start))
         stop = int(min(coords.stop, chrom_size))
-        seq = self._get_seq(chrom, start, stop)
+        if self._cache is None or stop <= start:
+            seq = self._get_seq(chrom, start, stop)
+        else:
+            seq = self._get_cached_seq(chrom, start, stop)
         seq_len = stop - start
         orig_len = coords.stop - coords.start
         if seq_len < orig_len:
@@ -59,10 +111,50 @@ class SignalWrapper:
     def _get_seq(self, chrom, start, stop):
         return None
 
+    def _get_cached_seq(self, chrom, start, stop):
+        chunk_size = self.cache_chunk_size
+        first_chunk = start // chunk_size
+        last_chunk = (stop - 1) // chunk_size
+        chunks = [self._get_chunk(chrom, i) for i in range(first_chunk, last_chunk + 1)]
+        seq = chunks[0] if len(chunks) == 1 else np.concatenate(chunks)
+        offset = first_chunk * chunk_size
+        return seq[start - offset:stop - offset]
+
+    def _get_chunk(self, chrom, i):
+        chunk = self._cache.get((chrom, i))
+        if chunk is None:
+            start = i * self.cache_chunk_size
+            stop = min(start + self.cache_chunk_size, self._chroms_size[chrom])
+            chunk = self._get_seq(chrom, start, stop)
+            # Sequences handed out are views of the cached chunk and must not be modified in place
+            chunk.flags.writeable = False
+            self._cache.put((chrom, i), chunk)
+        return chunk
+
+    def fill_windows(self, chroms, starts, length, out, max_block_ratio=2):
+        """Fills out[i] with the window of the given length starting at starts[i] on chroms[i]. Windows sharing a
+        chromosome are read as one contiguous block, unless the block spans more than max_block_ratio times the
+        requested bases, in which case they are read one at a time."""
+        for chrom in np.unique(chroms):
+            idx = np.flatnonzero(chroms == chrom)
+            chrom_starts = starts[idx]
+            block_start = chrom_starts.min()
+            block_stop = chrom_starts.max() + length
+            if block_stop - block_start > max_block_ratio * len(idx) * length:
+                for i, start in zip(idx, chrom_starts):
+                    out[i] = self[chrom, start:start + length]
+                continue
+            block = self[chrom, block_start:block_stop]
+            for i, offset in zip(idx, chrom_starts - block_start):
+                if self.channel_last:
+                    out[i] = block[offset:offset + length]
+                else:
+                    out[i] = block[..., offset:offset + length]
+
 
 class GenomeWrapper(SignalWrapper):
-    def __init__(self, alpha='dna', one_hot=True, channel_last=True, in_mem=False, thread_safe=False):
-        super().__init__(channel_last, in_mem, thread_safe)
+    def __init__(self, alpha='dna', one_hot=True, channel_last=True, in_mem=False, thread_safe=False, cache_bytes=0):
+        super().__init__(channel_last, in_mem, thread_safe, cache_bytes)
         alphabets = {
             'dna': np.array(['A', 'C', 'G', 'T']),
             'rna': np.array(['A', 'C', 'G', 'U']),
@@ -87,12 +179,36 @@ class GenomeWrapper(SignalWrapper):
             seq = self.residues == seq[:, np.newaxis]
             if not self.channel_last:
                 seq = seq.T
+        elif not seq.flags.writeable:
+            seq = seq.copy()
         return seq
 
+    def to_u8(self, u8_file, chunk_size=1048576):
+        """Writes the genome as a flat file of uint8 residue codes, plus a u8_file + '.json' index, for
+        MemmapGenomeWrapper"""
+        lookup = np.full(256, len(self.residues), dtype=np.uint8)
+        for code, residue in enumerate(self.residues):
+            lookup[ord(residue)] = code
+        chroms = OrderedDict()
+        offset = 0
+        with open(u8_file, 'wb') as f:
+            pbar = tqdm(self._chroms)
+            for chrom in pbar:
+                pbar.set_description(desc='Encoding sequence: ' + chrom)
+                chrom_size = self._chroms_size[chrom]
+                for start in range(0, chrom_size, chunk_size):
+                    seq = self._get_seq(chrom, start, min(start + chunk_size, chrom_size))
+                    f.write(lookup[seq.astype('S1').view(np.uint8)].tobytes())
+                chroms[chrom] = [offset, chrom_size]
+                offset += chrom_size
+        with open(u8_file + '.json', 'w') as f:
+            json.dump({'residues': self.residues.tolist(), 'default_value': self.default_value, 'chroms': chroms}, f)
+
 
 class TwoBitWrapper(GenomeWrapper):
-    def __init__(self, twobit_file, alpha='dna', one_hot=True, channel_last=True, in_mem=False, thread_safe=False):
-        super().__init__(alpha, one_hot, channel_last, in_mem, thread_safe)
+    def __init__(self, twobit_file, alpha='dna', one_hot=True, channel_last=True, in_mem=False, thread_safe=False,
+                 cache_bytes=0):
+        super().__init__(alpha, one_hot, channel_last, in_mem, thread_safe, cache_bytes)
         self.twobit = py2bit.open(twobit_file)
         self._chroms = list(self.twobit.chroms().keys())
         self._chroms_size = self.twobit.chroms()
@@ -137,8 +253,8 @@ class TwoBitWrapper(GenomeWrapper):
 
 class FastaWrapper(GenomeWrapper):
     def __init__(self, fasta_file, alpha='dna', one_hot=True, channel_last=True, in_mem=False, thread_safe=False,
-                 read_ahead=10000):
-        super().__init__(alpha, one_hot, channel_last, in_mem, thread_safe)
+                 read_ahead=10000, cache_bytes=0):
+        super().__init__(alpha, one_hot, channel_last, in_mem, thread_safe, cache_bytes)
         self.fasta = Fasta(fasta_file, as_raw=True, sequence_always_upper=True, read_ahead=read_ahead)
         self._chroms = list(self.fasta.keys())
         seq_lens = [len(self.fasta[chrom]) for chrom in self._chroms]
@@ -183,9 +299,63 @@ class FastaWrapper(GenomeWrapper):
         return seq
 
 
+class MemmapGenomeWrapper(GenomeWrapper):
+    def __init__(self, u8_file, one_hot=True, channel_last=True):
+        # Reads a genome written by GenomeWrapper.to_u8. Windows are zero-copy views of the memory-mapped file, one-hot
+        # encoded by a compiled kernel.
+        super().__init__(one_hot=one_hot, channel_last=channel_last, thread_safe=True)
+        with open(u8_file + '.json') as f:
+            index = json.load(f)
+        self.residues = np.array(index['residues'])
+        self.default_value = index['default_value']
+        self._alphabet = np.append(self.residues, self.default_value)
+        self._chroms = list(index['chroms'].keys())
+        self._chroms_size = {chrom: size for chrom, (_, size) in index['chroms'].items()}
+        self._offsets = {chrom: offset for chrom, (offset, _) in index['chroms'].items()}
+        # Copy-on-write keeps the views writeable, as numba requires, without ever modifying the file
+        self.u8 = np.memmap(u8_file, dtype=np.uint8, mode='c')
+
+    def _get_codes(self, chrom, start, stop):
+        # Residue codes of [start, stop), padded with the ambiguous residue code past either end of the chromosome
+        offset = self._offsets[chrom]
+        chrom_size = self._chroms_size[chrom]
+        if 0 <= start and stop <= chrom_size:
+            return np.asarray(self.u8[offset + start:offset + stop])
+        codes = np.full(stop - start, len(self.residues), dtype=np.uint8)
+        clipped_start = max(start, 0)
+        clipped_stop = min(stop, chrom_size)
+        if clipped_stop > clipped_start:
+            codes[clipped_start - start:clipped_stop - start] = self.u8[offset + clipped_start:offset + clipped_stop]
+        return codes
+
+    def _get_seq(self, chrom, start, stop):
+        return self._alphabet[self._get_codes(chrom, start, stop)]
+
+    def __getitem__(self, item):
+        if not (self.one_hot and self.channel_last):
+            return super().__getitem__(item)
+        if len(item) == 2:
+            chrom, coords = item
+            start, stop = int(coords.start), int(coords.stop)
+        else:
+            chrom = item
+            start, stop = 0, self._chroms_size[chrom]
+        seq = np.empty((stop - start, len(self.residues)), dtype=bool)
+        _one_hot(self._get_codes(chrom, start, stop), seq)
+        return seq
+
+    def fill_windows(self, chroms, starts, length, out, max_block_ratio=2):
+        """Encodes each window straight from the memory map into out, with no intermediate arrays"""
+        if not (self.one_hot and self.channel_last and out.dtype in _ONE_HOT_DTYPES and out.flags.c_contiguous):
+            return super().fill_windows(chroms, starts, length, out, max_block_ratio)
+        for i, (chrom, start) in enumerate(zip(chroms, starts)):
+            _one_hot(self._get_codes(chrom, int(start), int(start) + length), out[i])
+
+
 class BigWigWrapper(SignalWrapper):
-    def __init__(self, bigwig_file, channel_last=True, in_mem=False, thread_safe=False, default_value=0):
-        super().__init__(channel_last, in_mem, thread_safe)
+    def __init__(self, bigwig_file, channel_last=True, in_mem=False, thread_safe=False, default_value=0,
+                 cache_bytes=0):
+        super().__init__(channel_last, in_mem, thread_safe, cache_bytes)
         self.bigwig = pyBigWig.open(bigwig_file, 'r')
         self._chroms_size = self.bigwig.chroms()
         self._chroms = list(self._chroms_size.keys())
@@ -228,6 +398,8 @@ class BigWigWrapper(SignalWrapper):
 
     def __getitem__(self, item):
         seq = super().__getitem__(item)
+        if not seq.flags.writeable:
+            seq = seq.copy()
         if self.channel_last:
             seq = seq.reshape((-1, 1))
         else:
@@ -263,14 +435,18 @@ class BedWrapper:
         if sort_bed:
             self.bt = pbt.BedTool(bed_file).sort()
         self.genomic_interval_tree = GenomicIntervalTree()
+        self._segments = {}
         use_data = data_col is not None
         self.dtype = dtype
-        for interval in self.df.itertuples():
-            chrom = interval[1]
-            start = interval[2]
-            stop = interval[3]
-            data = interval[data_col] if use_data else True
-            self.genomic_interval_tree.add(chrom, start, stop, data)
+        # Positional interval columns, kept alongside the DataFrame so that consumers can avoid pandas. They are copied,
+        # since pandas may hand out read-only views that the compiled kernels reject.
+        self.columns = (np.array(self.df.iloc[:, 0], dtype=object),
+                        np.array(self.df.iloc[:, 1], dtype=np.int64),
+                        np.array(self.df.iloc[:, 2], dtype=np.int64))
+        chroms, starts, stops = (column.tolist() for column in self.columns)
+        data = self.df.iloc[:, data_col - 1].tolist() if use_data else [True] * len(self.df)
+        for chrom, start, stop, data_i in zip(chroms, starts, stops, data):
+            self.genomic_interval_tree.add(chrom, start, stop, data_i)
 
     def __len__(self):
         return len(self.df)
@@ -290,8 +466,37 @@ class BedWrapper:
             seq = seq.T
         return seq
 
+    def segments(self, chrom):
+        """Returns the intervals on a chromosome as sorted, non-overlapping start, end, and data arrays. Where
+        intervals overlap, the data of the later-starting interval takes precedence."""
+        if chrom not in self._segments:
+            seg_starts, seg_ends, seg_values = [], [], []
+            for interval in sorted(self.genomic_interval_tree.get(chrom, [])):
+                begin, end, value = interval.begin, interval.end, float(interval.data)
+                # Cut the part this interval overlaps out of the trailing segments, keeping the pieces on either side
+                overlapped = []
+                while seg_ends and seg_ends[-1] > begin:
+                    overlapped.append((seg_starts.pop(), seg_ends.pop(), seg_values.pop()))
+                overlapped.reverse()
+                pieces = []
+                if overlapped and overlapped[0][0] < begin:
+                    pieces.append((overlapped[0][0], begin, overlapped[0][2]))
+                pieces.append((begin, end, value))
+                pieces.extend((max(seg_start, end), seg_end, seg_value)
+                              for seg_start, seg_end, seg_value in overlapped if seg_end > end)
+                for seg_start, seg_end, seg_value in pieces:
+                    seg_starts.append(seg_start)
+                    seg_ends.append(seg_end)
+                    seg_values.append(seg_value)
+            self._segments[chrom] = (np.array(seg_starts, dtype=np.int64),
+                                     np.array(seg_ends, dtype=np.int64),
+                                     np.array(seg_values, dtype=np.float64))
+        return self._segments[chrom]
+
     def shuffle(self):
-        self.df = sklearn.utils.shuffle(self.df)
+        perm = np.random.permutation(len(self.df))
+        self.df = self.df.iloc[perm]
+        self.columns = tuple(column[perm] for column in self.columns)
 
     def chroms(self):
         return self._chroms
@@ -11,5 +11,5 @@ setup(version='0.1.0',
       author_email="daquang@umich.edu",
       packages=find_packages(),
       install_requires=['numpy', 'pybedtools', 'pyfaidx', 'pandas', 'keras',
-                        'pyBigWig', 'py2bit', 'tqdm', 'scikit-learn', 'intervaltree']
+                        'pyBigWig', 'py2bit', 'tqdm', 'intervaltree', 'numba']
       )